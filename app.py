@@ -1,13 +1,19 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex, CreateTable
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import pandas as pd
+import numpy as np
 import folium
 from folium import plugins
 import os
+import sqlite3
 from werkzeug.utils import secure_filename
 from datetime import datetime
+import time
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-key-change-in-production')
@@ -23,11 +29,30 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Por favor inicia sesión para acceder a esta página'
 
+
+@event.listens_for(Engine, 'connect')
+def activar_claves_foraneas(dbapi_connection, connection_record):
+    """SQLite solo aplica las claves foráneas (y ON DELETE CASCADE) si se activan en cada conexión"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
 # Crear carpetas necesarias
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('static', exist_ok=True)
 
 ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
+RADIO_TIERRA_KM = 6371.0088
+TIEMPO_MAXIMO_RUTA = 10.0
+# Con 4000 paradas la matriz de distancias float32 ocupa unos 64 MB
+MAX_PARADAS_RUTA = 4000
+TAMANO_LOTE_BORRADO = 5000
+# Las marcas de eliminación se conservan por revisiones y con un máximo por usuario;
+# los clientes con una revisión anterior a las marcas conservadas se resincronizan
+RETENCION_REVISIONES_MARCAS = 1000
+MAX_MARCAS_ELIMINACION = 50000
 
 # ==================== MODELOS ====================
 
@@ -40,9 +65,17 @@ class Usuario(UserMixin, db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False, index=True)
     contraseña = db.Column(db.String(255), nullable=False)
     fecha_registro = db.Column(db.DateTime, default=datetime.utcnow)
+    # Última revisión asignada a los cambios de sus ubicaciones
+    revision = db.Column(db.Integer, nullable=False, default=0)
+    # Revisión hasta la que se descartaron marcas de eliminación
+    revision_compactada = db.Column(db.Integer, nullable=False, default=0)
 
     # Relación con ubicaciones
-    ubicaciones = db.relationship('Ubicacion', backref='usuario', lazy=True, cascade='all, delete-orphan')
+    # passive_deletes: al borrar el usuario no se cargan sus filas, la BD las elimina en cascada
+    ubicaciones = db.relationship('Ubicacion', backref='usuario', lazy=True,
+                                  cascade='all, delete-orphan', passive_deletes=True)
+    eliminaciones = db.relationship('UbicacionEliminada', lazy=True,
+                                    cascade='all, delete-orphan', passive_deletes=True)
 
     def establecer_contraseña(self, contraseña):
         self.contraseña = generate_password_hash(contraseña)
@@ -64,9 +97,19 @@ class Ubicacion(db.Model):
     longitud = db.Column(db.Float, nullable=False)
     archivo_origen = db.Column(db.String(255), nullable=True)
     fecha_carga = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    revision = db.Column(db.Integer, nullable=False, default=0)
 
     # Relación con usuario
-    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id', ondelete='CASCADE'), nullable=False, index=True)
+
+    __table_args__ = (
+        db.Index('ix_ubicaciones_usuario_revision', 'usuario_id', 'revision'),
+        db.Index('ix_ubicaciones_usuario_archivo', 'usuario_id', 'archivo_origen'),
+        # Sin AUTOINCREMENT SQLite reutiliza el id más alto tras borrarlo, y una marca
+        # de eliminación antigua podría confundirse con una ubicación nueva
+        {'sqlite_autoincrement': True},
+    )
 
     def to_dict(self):
         return {
@@ -75,13 +118,34 @@ class Ubicacion(db.Model):
             'lat': self.latitud,
             'lon': self.longitud,
             'archivo_origen': self.archivo_origen,
-            'fecha_carga': self.fecha_carga.isoformat() if self.fecha_carga else None
+            'fecha_carga': self.fecha_carga.isoformat() if self.fecha_carga else None,
+            'fecha_actualizacion': self.fecha_actualizacion.isoformat() if self.fecha_actualizacion else None,
+            'revision': self.revision
         }
 
     def __repr__(self):
         return f'<Ubicacion {self.descripcion}>'
 
 
+class UbicacionEliminada(db.Model):
+    """Marca (tombstone) de una ubicación eliminada, usada por la sincronización incremental"""
+    __tablename__ = 'ubicaciones_eliminadas'
+
+    id = db.Column(db.Integer, primary_key=True)
+    ubicacion_id = db.Column(db.Integer, nullable=False)
+    revision = db.Column(db.Integer, nullable=False)
+    fecha_eliminacion = db.Column(db.DateTime, default=datetime.utcnow)
+
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id', ondelete='CASCADE'), nullable=False, index=True)
+
+    __table_args__ = (
+        db.Index('ix_ubicaciones_eliminadas_usuario_revision', 'usuario_id', 'revision'),
+    )
+
+    def __repr__(self):
+        return f'<UbicacionEliminada {self.ubicacion_id}>'
+
+
 # ==================== LOGIN MANAGER ====================
 
 @login_manager.user_loader
@@ -119,6 +183,292 @@ def parse_coordinates(coord_string):
         return None
 
 
+def siguiente_revision(usuario_id):
+    """
+    Incrementa y devuelve la revisión del usuario dentro de la transacción actual.
+    El UPDATE bloquea la fila del usuario hasta el commit, así las revisiones
+    se hacen visibles en el mismo orden en que se asignan.
+    """
+    db.session.execute(
+        db.update(Usuario)
+        .where(Usuario.id == usuario_id)
+        .values(revision=Usuario.revision + 1)
+    )
+    return db.session.execute(
+        db.select(Usuario.revision).where(Usuario.id == usuario_id)
+    ).scalar_one()
+
+
+def borrar_por_lotes(modelo, condicion, usuario_id=None, resincronizar=False):
+    """
+    Borra con DELETE por lotes las filas de modelo que cumplen la condición,
+    sin cargarlas en la sesión. Cada lote se confirma por separado para no
+    mantener bloqueos largos. Si se indica usuario_id (solo para Ubicacion),
+    deja una marca de eliminación por fila para la sincronización incremental;
+    con resincronizar=True, en lugar de marcas, cada lote eleva la revisión
+    compactada para que los clientes se resincronicen.
+    Devuelve la cantidad de filas borradas.
+    """
+    total = 0
+    ultimo = 0
+
+    while True:
+        # Paginación por clave: el último id del lote se busca a partir del lote
+        # anterior, sin volver a recorrer ni ordenar las filas que quedan
+        tope = db.session.execute(
+            db.select(modelo.id)
+            .where(condicion, modelo.id > ultimo)
+            .order_by(modelo.id)
+            .offset(TAMANO_LOTE_BORRADO - 1)
+            .limit(1)
+        ).scalar()
+
+        lote = [condicion, modelo.id > ultimo]
+        if tope is not None:
+            lote.append(modelo.id <= tope)
+
+        if usuario_id is not None:
+            revision = siguiente_revision(usuario_id)
+            if resincronizar:
+                # El umbral se confirma junto con el borrado del lote: ninguna fila
+                # desaparece sin que los clientes sepan que deben resincronizarse
+                db.session.execute(
+                    db.update(Usuario)
+                    .where(Usuario.id == usuario_id)
+                    .values(revision_compactada=revision)
+                )
+            else:
+                db.session.execute(
+                    db.insert(UbicacionEliminada).from_select(
+                        ['ubicacion_id', 'revision', 'fecha_eliminacion', 'usuario_id'],
+                        db.select(
+                            Ubicacion.id,
+                            db.literal(revision),
+                            db.literal(datetime.utcnow(), db.DateTime),
+                            Ubicacion.usuario_id
+                        ).where(*lote)
+                    )
+                )
+
+        borradas = db.session.execute(
+            db.delete(modelo)
+            .where(*lote)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+        if usuario_id is not None and borradas == 0:
+            # Nada más que borrar: descartar la revisión reservada
+            db.session.rollback()
+            break
+        db.session.commit()
+
+        total += borradas
+        if tope is None:
+            break
+        ultimo = tope
+
+    return total
+
+
+def compactar_marcas(usuario_id):
+    """
+    Descarta las marcas de eliminación más antiguas que la ventana de retención
+    (por revisiones y por cantidad) y registra hasta qué revisión se descartaron.
+    Se llama con la eliminación ya confirmada: los errores se registran y no se propagan.
+    """
+    try:
+        revision = db.session.execute(
+            db.select(Usuario.revision).where(Usuario.id == usuario_id)
+        ).scalar_one()
+        umbral = revision - RETENCION_REVISIONES_MARCAS
+
+        # Revisión de la marca que excede el máximo, contando desde la más reciente
+        por_cantidad = db.session.execute(
+            db.select(UbicacionEliminada.revision)
+            .where(UbicacionEliminada.usuario_id == usuario_id)
+            .order_by(UbicacionEliminada.revision.desc())
+            .offset(MAX_MARCAS_ELIMINACION)
+            .limit(1)
+        ).scalar()
+        if por_cantidad is not None:
+            umbral = max(umbral, por_cantidad)
+
+        # Registrar el umbral antes de borrar, para que ningún cliente pierda eliminaciones
+        db.session.execute(
+            db.update(Usuario)
+            .where(Usuario.id == usuario_id, Usuario.revision_compactada < umbral)
+            .values(revision_compactada=umbral)
+        )
+        db.session.commit()
+
+        # El umbral también lo elevan los borrados masivos sin marcas
+        compactada = db.session.execute(
+            db.select(Usuario.revision_compactada).where(Usuario.id == usuario_id)
+        ).scalar_one()
+        borrar_por_lotes(
+            UbicacionEliminada,
+            db.and_(UbicacionEliminada.usuario_id == usuario_id, UbicacionEliminada.revision <= compactada)
+        )
+    except Exception as e:
+        db.session.rollback()
+        print(f"[!] Error al compactar marcas de eliminación: {str(e)}")
+
+
+def invalidar_mapa(usuario_id):
+    """Elimina el mapa generado del usuario; se vuelve a generar al consultarlo"""
+    map_path = os.path.join('static', f'mapa_{usuario_id}.html')
+    if os.path.exists(map_path):
+        os.remove(map_path)
+
+
+def eliminar_archivo_subido(archivo_origen):
+    """Elimina el Excel subido si ya ninguna ubicación (de ningún usuario) lo referencia"""
+    if not archivo_origen:
+        return
+
+    en_uso = db.session.execute(
+        db.select(Ubicacion.id).where(Ubicacion.archivo_origen == archivo_origen).limit(1)
+    ).first()
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(archivo_origen))
+
+    if not en_uso and os.path.isfile(filepath):
+        os.remove(filepath)
+
+
+def generar_mapa(locations, usuario_id, inicio=None):
+    """
+    Genera el mapa folium del usuario y lo guarda en static/.
+    Si se indica un punto de inicio, las ubicaciones se asumen ordenadas
+    y se dibuja el recorrido como una polilínea.
+    """
+    map_center = list(inicio) if inicio else [locations[0]['lat'], locations[0]['lon']]
+    mapa = folium.Map(
+        location=map_center,
+        zoom_start=12,
+        tiles='OpenStreetMap'
+    )
+
+    if inicio:
+        folium.Marker(
+            location=list(inicio),
+            popup=folium.Popup('Inicio', max_width=300),
+            tooltip='Inicio',
+            icon=folium.Icon(color='green', icon='play')
+        ).add_to(mapa)
+
+    for orden, loc in enumerate(locations, start=1):
+        etiqueta = f"{orden}. {loc['descripcion']}" if inicio else loc['descripcion']
+        folium.Marker(
+            location=[loc['lat'], loc['lon']],
+            popup=folium.Popup(etiqueta, max_width=300),
+            tooltip=etiqueta,
+            icon=folium.Icon(color='red', icon='info-sign')
+        ).add_to(mapa)
+
+    if inicio:
+        puntos = [list(inicio)] + [[loc['lat'], loc['lon']] for loc in locations]
+        folium.PolyLine(puntos, color='#667eea', weight=4, opacity=0.8).add_to(mapa)
+
+    plugins.Fullscreen().add_to(mapa)
+
+    map_path = os.path.join('static', f'mapa_{usuario_id}.html')
+    mapa.save(map_path)
+    return map_path
+
+
+def matriz_distancias(lats, lons, tamano_bloque=256):
+    """
+    Matriz de distancias haversine (km) entre todos los puntos, en float32.
+    Se llena por bloques de filas para que los temporales no ocupen n×n.
+    """
+    lat = np.radians(np.asarray(lats, dtype=np.float64)).astype(np.float32)
+    lon = np.radians(np.asarray(lons, dtype=np.float64)).astype(np.float32)
+    cos_lat = np.cos(lat)
+
+    n = len(lat)
+    dist = np.empty((n, n), dtype=np.float32)
+
+    for inicio in range(0, n, tamano_bloque):
+        fin = min(inicio + tamano_bloque, n)
+        dlat = lat[inicio:fin, None] - lat[None, :]
+        dlon = lon[inicio:fin, None] - lon[None, :]
+        a = np.sin(dlat / 2) ** 2 + cos_lat[inicio:fin, None] * cos_lat[None, :] * np.sin(dlon / 2) ** 2
+        np.clip(a, 0.0, 1.0, out=a)
+        dist[inicio:fin] = 2 * RADIO_TIERRA_KM * np.arcsin(np.sqrt(a))
+
+    return dist
+
+
+def ruta_vecino_mas_cercano(dist):
+    """Ruta abierta desde el nodo 0 visitando siempre el punto no visitado más cercano"""
+    n = len(dist)
+    ruta = np.empty(n, dtype=np.int64)
+    visitado = np.zeros(n, dtype=bool)
+    actual = 0
+    ruta[0] = 0
+    visitado[0] = True
+
+    for paso in range(1, n):
+        fila = np.where(visitado, np.inf, dist[actual])
+        actual = int(np.argmin(fila))
+        ruta[paso] = actual
+        visitado[actual] = True
+
+    return ruta
+
+
+def mejorar_ruta_2opt(ruta, dist, tiempo_limite):
+    """
+    Mejora una ruta abierta (el nodo inicial queda fijo) invirtiendo tramos con 2-opt.
+    Para cada posición evalúa todos los cortes posibles de una vez con numpy y
+    aplica el mejor; se detiene al no haber mejoras o al agotar el tiempo límite.
+    """
+    ruta = ruta.copy()
+    n = len(ruta)
+    fin = time.monotonic() + tiempo_limite
+    mejorado = True
+
+    while mejorado and time.monotonic() < fin:
+        mejorado = False
+        for i in range(1, n - 1):
+            if time.monotonic() >= fin:
+                break
+
+            a, b = ruta[i - 1], ruta[i]
+            c = ruta[i + 1:]
+
+            # Invertir ruta[i..j]: se reemplazan (a,b) y (c,d) por (a,c) y (b,d).
+            # En el último punto no existe d porque la ruta es abierta.
+            delta = dist[a, c] - dist[a, b]
+            d = ruta[i + 2:]
+            delta[:-1] += dist[b, d] - dist[c[:-1], d]
+
+            k = int(np.argmin(delta))
+            if delta[k] < -1e-6:
+                j = i + 1 + k
+                ruta[i:j + 1] = ruta[i:j + 1][::-1].copy()
+                mejorado = True
+
+    return ruta
+
+
+def planificar_ruta(inicio, puntos, tiempo_limite=2.0):
+    """
+    Calcula un orden de visita casi óptimo partiendo de inicio.
+    Devuelve los índices de puntos en orden de visita y la distancia total en km.
+    """
+    lats = [inicio[0]] + [p[0] for p in puntos]
+    lons = [inicio[1]] + [p[1] for p in puntos]
+    dist = matriz_distancias(lats, lons)
+
+    ruta = ruta_vecino_mas_cercano(dist)
+    if len(ruta) > 3:
+        ruta = mejorar_ruta_2opt(ruta, dist, tiempo_limite)
+
+    total = float(dist[ruta[:-1], ruta[1:]].astype(np.float64).sum())
+    return [int(idx) - 1 for idx in ruta[1:]], total
+
+
 # ==================== RUTAS PÚBLICAS ====================
 
 @app.route('/')
@@ -289,6 +639,7 @@ def upload_file():
         # Procesar coordenadas
         locations = []
         errores = 0
+        revision = siguiente_revision(current_user.id)
 
         for idx, row in df.iterrows():
             coords = parse_coordinates(row['coordenadas'])
@@ -298,6 +649,7 @@ def upload_file():
                     latitud=coords[0],
                     longitud=coords[1],
                     archivo_origen=filename,
+                    revision=revision,
                     usuario_id=current_user.id
                 )
                 db.session.add(ubicacion)
@@ -316,25 +668,7 @@ def upload_file():
         db.session.commit()
 
         # Crear mapa
-        map_center = [locations[0]['lat'], locations[0]['lon']]
-        mapa = folium.Map(
-            location=map_center,
-            zoom_start=12,
-            tiles='OpenStreetMap'
-        )
-
-        for loc in locations:
-            folium.Marker(
-                location=[loc['lat'], loc['lon']],
-                popup=folium.Popup(loc['descripcion'], max_width=300),
-                tooltip=loc['descripcion'],
-                icon=folium.Icon(color='red', icon='info-sign')
-            ).add_to(mapa)
-
-        plugins.Fullscreen().add_to(mapa)
-
-        map_path = os.path.join('static', f'mapa_{current_user.id}.html')
-        mapa.save(map_path)
+        generar_mapa(locations, current_user.id)
 
         if errores > 0:
             flash(f'✅ {len(locations)} ubicaciones guardadas. {errores} coordenadas ignoradas', 'warning')
@@ -353,6 +687,25 @@ def upload_file():
 @login_required
 def ver_mapa():
     """Ver el mapa generado"""
+    map_path = os.path.join('static', f'mapa_{current_user.id}.html')
+
+    # El mapa se invalida al borrar datos: regenerarlo con lo que quede
+    if not os.path.exists(map_path):
+        filas = db.session.execute(
+            db.select(Ubicacion.descripcion, Ubicacion.latitud, Ubicacion.longitud)
+            .where(Ubicacion.usuario_id == current_user.id)
+            .order_by(Ubicacion.id)
+        ).all()
+
+        if not filas:
+            flash('No hay ubicaciones para mostrar en el mapa', 'warning')
+            return redirect(url_for('dashboard'))
+
+        generar_mapa(
+            [{'descripcion': d, 'lat': lat, 'lon': lon} for d, lat, lon in filas],
+            current_user.id
+        )
+
     return render_template('mapa.html', usuario=current_user)
 
 
@@ -377,6 +730,65 @@ def get_ubicaciones():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/ubicaciones/changes', methods=['GET'])
+@login_required
+def get_cambios_ubicaciones():
+    """Obtener solo las ubicaciones creadas, actualizadas o eliminadas desde una revisión"""
+    try:
+        since = request.args.get('since', 0, type=int)
+
+        # Leer la revisión actual antes que los cambios: lo que se confirme
+        # en medio llegará de nuevo en la siguiente sincronización
+        revision = db.session.execute(
+            db.select(Usuario.revision).where(Usuario.id == current_user.id)
+        ).scalar_one()
+
+        # Un cliente sin estado local (since=0) no necesita marcas de eliminación
+        eliminados = []
+        if since > 0:
+            # Omitir marcas cuyo id ya pertenece a una ubicación más reciente
+            reemplazada = db.exists().where(
+                Ubicacion.id == UbicacionEliminada.ubicacion_id,
+                Ubicacion.usuario_id == current_user.id,
+                Ubicacion.revision > UbicacionEliminada.revision
+            )
+            eliminados = db.session.execute(
+                db.select(UbicacionEliminada.ubicacion_id)
+                .where(
+                    UbicacionEliminada.usuario_id == current_user.id,
+                    UbicacionEliminada.revision > since,
+                    ~reemplazada
+                )
+                .order_by(UbicacionEliminada.revision)
+            ).scalars().all()
+
+        # Se lee después de las marcas: si se compactaron entretanto, se fuerza la resincronización
+        compactada = db.session.execute(
+            db.select(Usuario.revision_compactada).where(Usuario.id == current_user.id)
+        ).scalar_one()
+        # También si el cliente va por delante del servidor (BD restaurada o cuenta recreada)
+        resincronizar = 0 < since < compactada or since > revision
+        if resincronizar:
+            since = 0
+            eliminados = []
+
+        cambios = (
+            Ubicacion.query
+            .filter(Ubicacion.usuario_id == current_user.id, Ubicacion.revision > since)
+            .order_by(Ubicacion.revision, Ubicacion.id)
+            .all()
+        )
+
+        return jsonify({
+            'revision': revision,
+            'resincronizar': resincronizar,
+            'cambios': [loc.to_dict() for loc in cambios],
+            'eliminados': eliminados
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/ubicaciones/<int:id>', methods=['GET'])
 @login_required
 def get_ubicacion(id):
@@ -414,6 +826,7 @@ def crear_ubicacion():
             latitud=lat,
             longitud=lon,
             archivo_origen=data.get('archivo_origen', 'Manual'),
+            revision=siguiente_revision(current_user.id),
             usuario_id=current_user.id
         )
 
@@ -451,6 +864,7 @@ def actualizar_ubicacion(id):
             ubicacion.latitud = lat
             ubicacion.longitud = lon
 
+        ubicacion.revision = siguiente_revision(current_user.id)
         db.session.commit()
         return jsonify(ubicacion.to_dict())
     except Exception as e:
@@ -468,16 +882,263 @@ def eliminar_ubicacion(id):
         if ubicacion.usuario_id != current_user.id:
             return jsonify({'error': 'No tienes permiso'}), 403
 
+        db.session.add(UbicacionEliminada(
+            ubicacion_id=ubicacion.id,
+            revision=siguiente_revision(current_user.id),
+            usuario_id=current_user.id
+        ))
         db.session.delete(ubicacion)
         db.session.commit()
+
+        compactar_marcas(current_user.id)
         return jsonify({'mensaje': 'Ubicación eliminada'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/rutas', methods=['POST'])
+@login_required
+def planificar_ruta_api():
+    """Calcular el orden de visita de un conjunto de ubicaciones y dibujarlo en el mapa"""
+    try:
+        data = request.get_json()
+
+        if not data or ('ids' not in data and 'archivo_origen' not in data):
+            return jsonify({'error': 'Indique ids o archivo_origen'}), 400
+
+        error_limite = {'error': f'La ruta admite como máximo {MAX_PARADAS_RUTA} paradas'}
+
+        consulta = Ubicacion.query.filter_by(usuario_id=current_user.id)
+        if 'ids' in data:
+            if not isinstance(data['ids'], list):
+                return jsonify({'error': 'ids debe ser una lista'}), 400
+            ids = [int(i) for i in data['ids']]
+            if len(set(ids)) > MAX_PARADAS_RUTA:
+                return jsonify(error_limite), 400
+            consulta = consulta.filter(Ubicacion.id.in_(ids))
+        else:
+            consulta = consulta.filter_by(archivo_origen=str(data['archivo_origen']))
+
+        # Se pide una fila de más para detectar el exceso sin cargar todo el archivo
+        ubicaciones = consulta.order_by(Ubicacion.id).limit(MAX_PARADAS_RUTA + 1).all()
+        if not ubicaciones:
+            return jsonify({'error': 'No se encontraron ubicaciones'}), 404
+        if len(ubicaciones) > MAX_PARADAS_RUTA:
+            return jsonify(error_limite), 400
+
+        if 'inicio' in data:
+            lat = float(data['inicio']['latitud'])
+            lon = float(data['inicio']['longitud'])
+
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                return jsonify({'error': 'Coordenadas fuera de rango'}), 400
+
+            inicio = (lat, lon)
+        else:
+            inicio = (ubicaciones[0].latitud, ubicaciones[0].longitud)
+
+        tiempo_limite = min(float(data.get('tiempo_limite', 2.0)), TIEMPO_MAXIMO_RUTA)
+
+        orden, distancia = planificar_ruta(
+            inicio,
+            [(u.latitud, u.longitud) for u in ubicaciones],
+            tiempo_limite=max(tiempo_limite, 0.0)
+        )
+        ruta = [ubicaciones[i].to_dict() for i in orden]
+
+        generar_mapa(ruta, current_user.id, inicio=inicio)
+
+        return jsonify({
+            'inicio': {'lat': inicio[0], 'lon': inicio[1]},
+            'ruta': ruta,
+            'distancia_total_km': round(distancia, 3),
+            'mapa': url_for('ver_mapa')
+        })
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Datos de entrada inválidos'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/uploads/<path:archivo_origen>', methods=['DELETE'])
+@login_required
+def eliminar_upload(archivo_origen):
+    """Eliminar todas las ubicaciones cargadas desde un archivo"""
+    try:
+        condicion = db.and_(Ubicacion.usuario_id == current_user.id, Ubicacion.archivo_origen == archivo_origen)
+        cantidad = db.session.execute(
+            db.select(db.func.count()).select_from(Ubicacion).where(condicion)
+        ).scalar()
+
+        if cantidad == 0:
+            return jsonify({'error': 'No se encontraron ubicaciones de ese archivo'}), 404
+
+        # Con más filas que el máximo de marcas, estas se descartarían enseguida:
+        # borrar sin ellas y forzar la resincronización de los clientes
+        borradas = borrar_por_lotes(
+            Ubicacion,
+            condicion,
+            usuario_id=current_user.id,
+            resincronizar=cantidad > MAX_MARCAS_ELIMINACION
+        )
+        compactar_marcas(current_user.id)
+        invalidar_mapa(current_user.id)
+        eliminar_archivo_subido(archivo_origen)
+
+        return jsonify({'mensaje': 'Archivo eliminado', 'ubicaciones_eliminadas': borradas})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/cuenta', methods=['DELETE'])
+@login_required
+def eliminar_cuenta():
+    """Eliminar la cuenta del usuario autenticado junto con todos sus datos"""
+    try:
+        data = request.get_json(silent=True) or {}
+        contraseña = data.get('contraseña')
+
+        if not isinstance(contraseña, str) or not contraseña:
+            return jsonify({'error': 'Se requiere la contraseña'}), 400
+
+        if not current_user.verificar_contraseña(contraseña):
+            return jsonify({'error': 'Contraseña incorrecta'}), 403
+
+        usuario_id = current_user.id
+        archivos = db.session.execute(
+            db.select(Ubicacion.archivo_origen)
+            .where(Ubicacion.usuario_id == usuario_id)
+            .distinct()
+        ).scalars().all()
+
+        # Sin marcas de eliminación: la cuenta deja de existir
+        borradas = borrar_por_lotes(Ubicacion, Ubicacion.usuario_id == usuario_id)
+        borrar_por_lotes(UbicacionEliminada, UbicacionEliminada.usuario_id == usuario_id)
+
+        db.session.execute(db.delete(Usuario).where(Usuario.id == usuario_id))
+        db.session.commit()
+        # Solo cerrar la sesión cuando la cuenta ya no existe
+        logout_user()
+
+        invalidar_mapa(usuario_id)
+        for archivo in archivos:
+            eliminar_archivo_subido(archivo)
+
+        return jsonify({'mensaje': 'Cuenta eliminada', 'ubicaciones_eliminadas': borradas})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+
 # ==================== CREAR TABLAS ====================
 
+def migrar_revisiones():
+    """Agregar las columnas de control de cambios a bases de datos creadas antes de existir"""
+    inspector = db.inspect(db.engine)
+    columnas_usuarios = [col['name'] for col in inspector.get_columns('usuarios')]
+    columnas_ubicaciones = [col['name'] for col in inspector.get_columns('ubicaciones')]
+
+    with db.engine.begin() as conn:
+        # Las filas existentes quedan en la revisión 1, incluida en since=0
+        if 'revision' not in columnas_usuarios:
+            print("[*] Agregando columna revision a usuarios...")
+            conn.execute(db.text('ALTER TABLE usuarios ADD COLUMN revision INTEGER NOT NULL DEFAULT 1'))
+        if 'revision_compactada' not in columnas_usuarios:
+            conn.execute(db.text('ALTER TABLE usuarios ADD COLUMN revision_compactada INTEGER NOT NULL DEFAULT 0'))
+        if 'revision' not in columnas_ubicaciones:
+            print("[*] Agregando columna revision a ubicaciones...")
+            conn.execute(db.text('ALTER TABLE ubicaciones ADD COLUMN revision INTEGER NOT NULL DEFAULT 1'))
+        if 'fecha_actualizacion' not in columnas_ubicaciones:
+            conn.execute(db.text('ALTER TABLE ubicaciones ADD COLUMN fecha_actualizacion TIMESTAMP'))
+            conn.execute(db.text('UPDATE ubicaciones SET fecha_actualizacion = fecha_carga'))
+
+    for modelo in (Ubicacion, UbicacionEliminada):
+        for indice in modelo.__table__.indexes:
+            indice.create(bind=db.engine, checkfirst=True)
+
+
+def reconstruir_tabla_sqlite(tabla, indices):
+    """
+    SQLite no permite modificar claves foráneas: renombra la tabla, la crea de
+    nuevo con el esquema actual y copia las filas, todo en una transacción.
+    """
+    antigua = f'{tabla.name}_anterior'
+    columnas = ', '.join(col.name for col in tabla.columns)
+    sentencias = [CreateTable(tabla)] + [CreateIndex(indice) for indice in tabla.indexes]
+
+    conexion = db.engine.raw_connection()
+    sqlite = conexion.driver_connection
+    nivel = sqlite.isolation_level
+    # BEGIN/COMMIT explícitos para que también la DDL sea atómica
+    sqlite.isolation_level = None
+    try:
+        # El PRAGMA no tiene efecto dentro de una transacción
+        sqlite.execute('PRAGMA foreign_keys=OFF')
+        sqlite.execute('BEGIN')
+        try:
+            for nombre in indices:
+                sqlite.execute(f'DROP INDEX "{nombre}"')
+            sqlite.execute(f'ALTER TABLE {tabla.name} RENAME TO {antigua}')
+            for sentencia in sentencias:
+                sqlite.execute(str(sentencia.compile(dialect=db.engine.dialect)))
+            sqlite.execute(f'INSERT INTO {tabla.name} ({columnas}) SELECT {columnas} FROM {antigua}')
+            sqlite.execute(f'DROP TABLE {antigua}')
+            sqlite.execute('COMMIT')
+        except Exception:
+            sqlite.execute('ROLLBACK')
+            raise
+    finally:
+        sqlite.execute('PRAGMA foreign_keys=ON')
+        sqlite.isolation_level = nivel
+        conexion.close()
+
+
+def sqlite_sin_autoincremento(tabla):
+    """Indica si la tabla debería usar AUTOINCREMENT en SQLite y fue creada sin él"""
+    if db.engine.dialect.name != 'sqlite' or not tabla.kwargs.get('sqlite_autoincrement'):
+        return False
+
+    with db.engine.connect() as conn:
+        sql = conn.execute(
+            db.text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :nombre"),
+            {'nombre': tabla.name}
+        ).scalar()
+    return 'AUTOINCREMENT' not in (sql or '').upper()
+
+
+def migrar_claves():
+    """
+    Recrear con ON DELETE CASCADE las claves foráneas hacia usuarios y, en SQLite,
+    con AUTOINCREMENT los ids que lo requieren, en bases de datos anteriores
+    """
+    inspector = db.inspect(db.engine)
+
+    for modelo in (Ubicacion, UbicacionEliminada):
+        tabla = modelo.__table__
+        pendientes = [
+            fk for fk in inspector.get_foreign_keys(tabla.name)
+            if fk['referred_table'] == 'usuarios' and (fk['options'].get('ondelete') or '').upper() != 'CASCADE'
+        ]
+        sin_autoincremento = sqlite_sin_autoincremento(tabla)
+        if not pendientes and not sin_autoincremento:
+            continue
+
+        print(f"[*] Actualizando claves de {tabla.name}...")
+        if db.engine.dialect.name == 'sqlite':
+            indices = [indice['name'] for indice in inspector.get_indexes(tabla.name)]
+            reconstruir_tabla_sqlite(tabla, indices)
+        else:
+            with db.engine.begin() as conn:
+                for fk in pendientes:
+                    conn.execute(db.text(f'ALTER TABLE {tabla.name} DROP CONSTRAINT {fk["name"]}'))
+                conn.execute(db.text(
+                    f'ALTER TABLE {tabla.name} ADD CONSTRAINT {tabla.name}_usuario_id_fkey '
+                    'FOREIGN KEY (usuario_id) REFERENCES usuarios (id) ON DELETE CASCADE'
+                ))
+
+
 def init_db():
     """Inicializar base de datos con auto-reparación"""
     with app.app_context():
@@ -504,6 +1165,14 @@ def init_db():
             except Exception as repair_error:
                 print(f"[!] Error en reparación: {str(repair_error)}")
 
+        # Fuera del bloque de reparación: un fallo al migrar nunca debe borrar los datos
+        try:
+            migrar_revisiones()
+            migrar_claves()
+        except Exception as e:
+            print(f"[!] Error al migrar BD: {str(e)}")
+            raise
+
 # Inicializar BD al iniciar la app
 init_db()
 
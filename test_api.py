@@ -8,6 +8,12 @@ import json
 from datetime import datetime
 
 BASE_URL = "http://localhost:5000/api/ubicaciones"
+SERVER_URL = "http://localhost:5000"
+
+# La API requiere sesión: se usa el usuario de demo creado por reset_db.py
+EMAIL_DEMO = "demo@test.com"
+CONTRASEÑA_DEMO = "123456"
+sesion = requests.Session()
 
 def print_separator():
     print("\n" + "="*60 + "\n")
@@ -17,7 +23,7 @@ def test_get_all():
     print("1️⃣  PRUEBA: Obtener todas las ubicaciones")
     print("-" * 60)
     try:
-        response = requests.get(BASE_URL)
+        response = sesion.get(BASE_URL)
         print(f"Status Code: {response.status_code}")
         data = response.json()
         print(f"Cantidad de ubicaciones: {len(data)}")
@@ -43,7 +49,7 @@ def test_create():
         }
         print(f"Datos enviados: {json.dumps(nueva_ubicacion, indent=2)}")
 
-        response = requests.post(BASE_URL, json=nueva_ubicacion)
+        response = sesion.post(BASE_URL, json=nueva_ubicacion)
         print(f"\nStatus Code: {response.status_code}")
         data = response.json()
         print(f"Ubicación creada: {data['descripcion']} (ID: {data['id']})")
@@ -57,7 +63,7 @@ def test_get_by_id(location_id):
     print(f"\n3️⃣  PRUEBA: Obtener ubicación por ID ({location_id})")
     print("-" * 60)
     try:
-        response = requests.get(f"{BASE_URL}/{location_id}")
+        response = sesion.get(f"{BASE_URL}/{location_id}")
         print(f"Status Code: {response.status_code}")
         data = response.json()
         print(f"Ubicación encontrada: {data['descripcion']}")
@@ -79,7 +85,7 @@ def test_update(location_id):
         }
         print(f"Datos a actualizar: {json.dumps(datos_actualizados, indent=2)}")
 
-        response = requests.put(f"{BASE_URL}/{location_id}", json=datos_actualizados)
+        response = sesion.put(f"{BASE_URL}/{location_id}", json=datos_actualizados)
         print(f"\nStatus Code: {response.status_code}")
         data = response.json()
         print(f"Ubicación actualizada: {data['descripcion']}")
@@ -93,7 +99,7 @@ def test_delete(location_id):
     print(f"\n5️⃣  PRUEBA: Eliminar ubicación (ID: {location_id})")
     print("-" * 60)
     try:
-        response = requests.delete(f"{BASE_URL}/{location_id}")
+        response = sesion.delete(f"{BASE_URL}/{location_id}")
         print(f"Status Code: {response.status_code}")
         data = response.json()
         print(f"Resultado: {data['mensaje']}")
@@ -102,6 +108,93 @@ def test_delete(location_id):
         print(f"❌ Error: {str(e)}")
         return False
 
+def iniciar_sesion():
+    """Inicia sesión con el usuario de demo"""
+    response = sesion.post(f"{SERVER_URL}/login", data={
+        "email": EMAIL_DEMO,
+        "contraseña": CONTRASEÑA_DEMO
+    })
+    # Con credenciales válidas el login redirige al dashboard
+    return response.ok and "/dashboard" in response.url
+
+def obtener_revision():
+    """Revisión actual de sincronización del usuario"""
+    return sesion.get(f"{BASE_URL}/changes?since=0").json()["revision"]
+
+def crear_ubicacion(descripcion, archivo_origen="test_api.py"):
+    """Crea una ubicación de prueba y devuelve su ID"""
+    response = sesion.post(BASE_URL, json={
+        "descripcion": descripcion,
+        "latitud": -12.0462,
+        "longitud": -77.0371,
+        "archivo_origen": archivo_origen
+    })
+    return response.json()["id"]
+
+def test_delta_id_reutilizado():
+    """Prueba: Sincronización incremental tras crear, eliminar y volver a crear"""
+    print("\n6️⃣  PRUEBA: Cambios con crear / eliminar / crear")
+    print("-" * 60)
+    try:
+        revision = obtener_revision()
+
+        eliminada_id = crear_ubicacion("Delta eliminada")
+        sesion.delete(f"{BASE_URL}/{eliminada_id}")
+        nueva_id = crear_ubicacion("Delta nueva")
+        print(f"ID eliminado: {eliminada_id} | ID nuevo: {nueva_id}")
+
+        response = sesion.get(f"{BASE_URL}/changes?since={revision}")
+        print(f"Status Code: {response.status_code}")
+        data = response.json()
+        cambios = [loc["id"] for loc in data["cambios"]]
+        print(f"Cambios: {cambios} | Eliminados: {data['eliminados']}")
+
+        # La ubicación nueva debe llegar y nunca aparecer como eliminada,
+        # aunque la base de datos le haya asignado el ID de la eliminada
+        ok = (
+            response.status_code == 200
+            and nueva_id in cambios
+            and nueva_id not in data["eliminados"]
+            and (eliminada_id == nueva_id or eliminada_id in data["eliminados"])
+        )
+
+        sesion.delete(f"{BASE_URL}/{nueva_id}")
+        return ok
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return False
+
+def test_delete_upload():
+    """Prueba: Eliminar todas las ubicaciones de un archivo"""
+    print("\n7️⃣  PRUEBA: Eliminar ubicaciones por archivo origen")
+    print("-" * 60)
+    try:
+        archivo = "test_api_" + datetime.now().strftime("%H%M%S") + ".xlsx"
+        ids = [crear_ubicacion(f"Upload {i}", archivo_origen=archivo) for i in range(3)]
+        revision = obtener_revision()
+        print(f"Archivo: {archivo} | IDs: {ids}")
+
+        response = sesion.delete(f"{SERVER_URL}/api/uploads/{archivo}")
+        print(f"Status Code: {response.status_code}")
+        data = response.json()
+        print(f"Resultado: {data.get('mensaje')} ({data.get('ubicaciones_eliminadas')} ubicaciones)")
+
+        cambios = sesion.get(f"{BASE_URL}/changes?since={revision}").json()
+        print(f"Eliminados en la sincronización: {cambios['eliminados']}")
+
+        repetido = sesion.delete(f"{SERVER_URL}/api/uploads/{archivo}")
+        print(f"Segundo intento - Status Code: {repetido.status_code}")
+
+        return (
+            response.status_code == 200
+            and data.get("ubicaciones_eliminadas") == len(ids)
+            and (cambios["resincronizar"] or set(ids) <= set(cambios["eliminados"]))
+            and repetido.status_code == 404
+        )
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return False
+
 def main():
     print("\n")
     print("╔" + "="*58 + "╗")
@@ -120,6 +213,12 @@ def main():
         print("   Asegúrate de que la aplicación está corriendo: python app.py")
         return
 
+    if not iniciar_sesion():
+        print(f"❌ No se pudo iniciar sesión como {EMAIL_DEMO}")
+        print("   Crea el usuario de demo con: python reset_db.py")
+        return
+    print(f"✅ Sesión iniciada como {EMAIL_DEMO}")
+
     results = []
 
     # Pruebas
@@ -140,6 +239,12 @@ def main():
         results.append(("Eliminar", test_delete(location_id)))
         print_separator()
 
+    results.append(("Cambios con ID reutilizado", test_delta_id_reutilizado()))
+    print_separator()
+
+    results.append(("Eliminar por archivo", test_delete_upload()))
+    print_separator()
+
     # Resumen
     print("\n📊 RESUMEN DE PRUEBAS")
     print("="*60)